@@ -1,11 +1,25 @@
 import logging
+import asyncio
+from collections import deque, OrderedDict
+from aiolimiter import AsyncLimiter
 from telegram import Update
+from telegram.error import RetryAfter, TimedOut
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable, InternalServerError
+from tenacity import (
+    AsyncRetrying, before_sleep_log, retry_if_exception_type,
+    stop_after_attempt, wait_exponential_jitter
+)
 from io import BytesIO
 import os
-from flask import Flask
-from threading import Thread
+import time
+import functools
+from types import MappingProxyType
+from itertools import groupby
+from operator import itemgetter
+from aiohttp import web
+import aiosqlite
 import re
 
 # Configuration
@@ -20,78 +34,362 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 # Store user sessions (chat history + settings)
-user_sessions = {}
-
-# ===== FLASK WEB SERVER (THE HACK!) =====
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "🤖 Bot is running! This is just a dummy server to keep Render happy."
+# LRU: least recently active users get dropped once we hit MAX_SESSIONS
+# (they get reloaded from the session DB next time they show up)
+user_sessions = OrderedDict()
+MAX_SESSIONS = 10_000
+
+# ===== SESSION DB (WRITE-BEHIND) =====
+# Sessions survive restarts. Handlers only queue writes; a background task
+# batches them into SQLite so the DB never adds latency to a reply.
+SESSIONS_DB = os.environ.get("SESSIONS_DB", "sessions.db")
+DB_FLUSH_INTERVAL = 0.2  # seconds
+
+db = None
+db_queue = asyncio.Queue()
+db_writer_task = None
+
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INTEGER PRIMARY KEY,
+    system_prompt TEXT,
+    temperature REAL,
+    model_name TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    ts REAL,
+    role TEXT,
+    content TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, id);
+"""
+
+# Queued ops look like (kind, *params) - params go straight into these
+_DB_WRITES = {
+    "message": "INSERT INTO messages (user_id, ts, role, content) VALUES (?, ?, ?, ?)",
+    "settings": "INSERT OR REPLACE INTO sessions (user_id, system_prompt, temperature, model_name) VALUES (?, ?, ?, ?)",
+    "clear": "DELETE FROM messages WHERE user_id = ?",
+}
+# Only keep the last N messages per user on disk too
+_DB_PRUNE = """
+DELETE FROM messages WHERE user_id = ? AND id NOT IN (
+    SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?
+)
+"""
+
+def db_enqueue(*op):
+    if db is not None:
+        db_queue.put_nowait(op)
+
+async def _write_batch(ops, max_history):
+    # Keep the original order, but executemany runs of the same kind
+    for kind, group in groupby(ops, key=itemgetter(0)):
+        await db.executemany(_DB_WRITES[kind], [op[1:] for op in group])
+    touched = {op[1] for op in ops if op[0] == "message"}
+    await db.executemany(_DB_PRUNE, [(uid, uid, max_history) for uid in touched])
+    await db.commit()
+
+def _drain_queue():
+    ops = []
+    while not db_queue.empty():
+        ops.append(db_queue.get_nowait())
+    return ops
+
+_DB_STOP = object()  # Queued by close_session_db: write what you have, then exit
+
+async def db_writer():
+    """Background task: flush queued writes every DB_FLUSH_INTERVAL"""
+    while True:
+        ops = [await db_queue.get()]
+        if ops[0] is not _DB_STOP:
+            await asyncio.sleep(DB_FLUSH_INTERVAL)
+        ops.extend(_drain_queue())
+        
+        stop = any(op is _DB_STOP for op in ops)
+        ops = [op for op in ops if op is not _DB_STOP]
+        if ops:
+            try:
+                await _write_batch(ops, UserSession.max_history)
+            except Exception as e:
+                logger.error(f"Session DB write failed ({len(ops)} ops dropped): {e}")
+        if stop:
+            return
 
-@app.route('/health')
-def health():
-    return {"status": "alive", "bot": "running"}
+async def open_session_db():
+    global db, db_writer_task
+    try:
+        db = await aiosqlite.connect(SESSIONS_DB)
+        await db.executescript(_DB_SCHEMA)
+        await db.commit()
+    except Exception as e:
+        logger.error(f"Couldn't open session DB, sessions won't persist: {e}")
+        db = None
+        return
+    db_writer_task = asyncio.create_task(db_writer())
+    logger.info(f"💾 Session DB ready: {SESSIONS_DB}")
 
-def run_flask():
-    """Run Flask server on the port Render expects"""
+async def close_session_db():
+    global db
+    if db is None:
+        return
+    # Don't cancel the writer - it may be holding a batch it hasn't written yet.
+    # Ask it to finish instead, then flush anything queued after it stopped.
+    db_queue.put_nowait(_DB_STOP)
+    await db_writer_task
+    ops = _drain_queue()
+    if ops:
+        await _write_batch(ops, UserSession.max_history)
+    await db.close()
+    db = None
+
+async def load_session(user_id):
+    """Build a session from the DB (or a fresh one if we've never seen this user)"""
+    session = UserSession(user_id)
+    if db is None:
+        return session
+    
+    async with db.execute(
+        "SELECT system_prompt, temperature, model_name FROM sessions WHERE user_id = ?", (user_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        session.system_prompt, session.temperature, session.model_name = row
+    
+    # Newest max_history messages, oldest first
+    async with db.execute(
+        "SELECT role, content FROM (SELECT id, role, content FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?) ORDER BY id",
+        (user_id, session.max_history)
+    ) as cursor:
+        async for role, content in cursor:
+            session.history.append((role, content))
+    return session
+# =====================================
+
+# ===== WEB SERVER (THE HACK!) =====
+# Runs on the bot's own event loop - no extra thread, no Flask
+web_runner = None
+
+# Render probes these a lot - bodies are encoded once, not per request
+_HOME_BODY = "🤖 Bot is running! This is just a dummy server to keep Render happy.".encode()
+_HEALTH_BODY = b'{"status": "alive", "bot": "running"}'
+
+async def home(request):
+    return web.Response(body=_HOME_BODY, content_type='text/plain', charset='utf-8')
+
+async def health(request):
+    return web.Response(body=_HEALTH_BODY, content_type='application/json')
+
+async def start_web_server(application):
+    """Serve the dummy endpoints on the port Render expects (post_init hook)"""
+    global web_runner
+    app = web.Application()
+    app.router.add_get('/', home)
+    app.router.add_get('/health', health)
+    
+    web_runner = web.AppRunner(app)
+    await web_runner.setup()
     port = int(os.environ.get("PORT", 10000))
-    app.run(host='0.0.0.0', port=port)
-# ========================================
+    await web.TCPSite(web_runner, '0.0.0.0', port).start()
+    logger.info(f"🌐 Web server started on port {port}!")
+
+async def stop_web_server(application):
+    if web_runner is not None:
+        await web_runner.cleanup()
+
+async def post_init(application):
+    await open_session_db()
+    await start_web_server(application)
+
+async def post_shutdown(application):
+    await stop_web_server(application)
+    await close_session_db()
+# ==================================
+
+# ===== OUTGOING RATE LIMITS =====
+# Telegram allows ~30 msgs/sec per bot and ~1 msg/sec per chat.
+# Stay a little under the global cap so bursts get queued instead of 429'd.
+GLOBAL_LIMITER = AsyncLimiter(28, 1)
+# Per-chat limiters live in an LRU too, so chats we talked to once don't stay forever
+PER_CHAT_LIMITERS = OrderedDict()
+MAX_CHAT_LIMITERS = 10_000
+
+def _lru_limiter(limiters, key, max_rate, time_period, max_size):
+    """Get (or create) key's AsyncLimiter, evicting the least recently used past max_size"""
+    limiter = limiters.get(key)
+    if limiter is not None:
+        limiters.move_to_end(key)
+        return limiter
+    
+    limiter = limiters[key] = AsyncLimiter(max_rate, time_period)
+    if len(limiters) > max_size:
+        limiters.popitem(last=False)
+    return limiter
+
+_backoff = wait_exponential_jitter(max=30)  # 1s, 2s, 4s... (+ up to 1s jitter)
+
+def _telegram_wait(retry_state):
+    # Flood control tells us exactly how long to wait; otherwise back off
+    e = retry_state.outcome.exception()
+    if isinstance(e, RetryAfter):
+        return e.retry_after
+    return _backoff(retry_state)
+
+async def safe_send(update, coro_factory):
+    """
+    Run a Telegram send through the rate limiters.
+    Retries flood control (429) and timeouts.
+    coro_factory must build a NEW coroutine each call (we may retry it).
+    """
+    # The wait between attempts happens outside the limiters so other chats keep flowing
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type((RetryAfter, TimedOut)),
+        wait=_telegram_wait,
+        stop=stop_after_attempt(5),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True
+    ):
+        with attempt:
+            chat_limiter = _lru_limiter(PER_CHAT_LIMITERS, update.effective_chat.id, 1, 1, MAX_CHAT_LIMITERS)
+            async with GLOBAL_LIMITER, chat_limiter:
+                return await coro_factory()
+
+async def safe_reply(update, text, **kwargs):
+    """Rate-limited update.message.reply_text"""
+    return await safe_send(update, lambda: update.message.reply_text(text, **kwargs))
+# ================================
+
+# ===== GEMINI RATE LIMITS (PER USER) =====
+# One user spamming shouldn't burn the shared API key's quota for everyone.
+USER_RATE_LIMIT = 20        # Gemini requests per minute
+PRIORITY_RATE_LIMIT = 60    # For user IDs listed in PRIORITY_USER_IDS
+PRIORITY_USER_IDS = {
+    int(uid) for uid in os.environ.get("PRIORITY_USER_IDS", "").split(",") if uid.strip()
+}
+# LRU-capped like user_sessions, so it doesn't grow with every user ever seen
+USER_LIMITERS = OrderedDict()
+MAX_USER_LIMITERS = 10_000
+
+def limiter_for(user_id):
+    rate = PRIORITY_RATE_LIMIT if user_id in PRIORITY_USER_IDS else USER_RATE_LIMIT
+    return _lru_limiter(USER_LIMITERS, user_id, rate, 60, MAX_USER_LIMITERS)
+
+RATE_LIMIT_MSG = "⏳ Whoa, slow down! You're sending requests too fast. Try again in a minute."
+
+async def gemini_call(coro_factory):
+    """
+    Await a Gemini request, retrying quota (429) and server (5xx) errors
+    with exponential backoff + jitter instead of failing the turn.
+    """
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable, InternalServerError)),
+        wait=_backoff,
+        stop=stop_after_attempt(4),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True
+    ):
+        with attempt:
+            return await coro_factory()
+# ==========================================
 
 # ===== IMPROVED HTML CONVERTER (MORE RELIABLE!) =====
+# ONE pattern for every markdown construct we support, so each message is
+# scanned once. Order matters: fence before inline code, bold before italic,
+# bullets before italic (so "* item" isn't read as the start of *italic*).
+_MD = re.compile(
+    r'(?P<fence>```[\w]*\n?(?P<fence_body>[\s\S]*?)```)'
+    r'|(?P<icode>`(?P<icode_body>[^`]+)`)'
+    r'|(?P<hdr>^#{1,6}\s+(?P<hdr_body>.*?)$)'
+    r'|(?P<bold1>\*\*(?P<bold1_body>.*?)\*\*)'
+    r'|(?P<bold2>__(?P<bold2_body>.*?)__)'
+    r'|(?P<bullet>^[\*\-]\s+)'
+    r'|(?P<ital1>(?<!\*)\*(?P<ital1_body>[^\*]+?)\*(?!\*))'
+    r'|(?P<ital2>(?<!_)_(?P<ital2_body>[^_]+?)_(?!_))',
+    re.MULTILINE
+)
+_RE_TAG = re.compile(r'<[^>]+>')
+_RE_MDCHARS = re.compile(r'[*_`]')
+_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# Code is escaped but never formatted; everything else can contain more markdown
+_HANDLERS = {
+    "fence": lambda m: f"<pre>{m.group('fence_body').translate(_ESCAPE_TABLE)}</pre>",
+    "icode": lambda m: f"<code>{m.group('icode_body').translate(_ESCAPE_TABLE)}</code>",
+    "hdr": lambda m: f"<b>{_render(m.group('hdr_body'))}</b>",
+    "bold1": lambda m: f"<b>{_render(m.group('bold1_body'))}</b>",
+    "bold2": lambda m: f"<b>{_render(m.group('bold2_body'))}</b>",
+    "bullet": lambda m: "• ",
+    "ital1": lambda m: f"<i>{_render(m.group('ital1_body'))}</i>",
+    "ital2": lambda m: f"<i>{_render(m.group('ital2_body'))}</i>",
+}
+
+def _render(text):
+    # Walk the matches once: escape the plain text between them,
+    # hand each match to its handler (lastgroup = the outer named group)
+    out = []
+    last = 0
+    for m in _MD.finditer(text):
+        out.append(text[last:m.start()].translate(_ESCAPE_TABLE))
+        out.append(_HANDLERS[m.lastgroup](m))
+        last = m.end()
+    out.append(text[last:].translate(_ESCAPE_TABLE))
+    return ''.join(out)
+
 def convert_to_html(text):
     """
     Convert markdown to HTML - WAY more reliable than Markdown!
     Telegram HTML supports: <b>, <i>, <code>, <pre>, <a>
+    Special chars (<, >, &) are escaped, except in the tags we generate.
     """
-    # Protect code blocks first
-    code_blocks = []
-    def save_code_block(match):
-        code_blocks.append(match.group(0))
-        return f"___CODE_BLOCK_{len(code_blocks)-1}___"
-    
-    # Save triple backtick code blocks (```code```)
-    text = re.sub(r'```[\w]*\n?([\s\S]*?)```', lambda m: f"<pre>{m.group(1)}</pre>", text)
-    
-    # Inline code (`code`)
-    text = re.sub(r'`([^`]+)`', r'<code>\1</code>', text)
-    
-    # Headers (# Header) -> Bold
-    text = re.sub(r'^#{1,6}\s+(.*?)$', r'<b>\1</b>', text, flags=re.MULTILINE)
-    
-    # Bold **text** or __text__
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    text = re.sub(r'__(.*?)__', r'<b>\1</b>', text)
-    
-    # Italic *text* or _text_ (but not if it's part of **)
-    text = re.sub(r'(?<!\*)\*([^\*]+?)\*(?!\*)', r'<i>\1</i>', text)
-    text = re.sub(r'(?<!_)_([^_]+?)_(?!_)', r'<i>\1</i>', text)
-    
-    # Bullet points
-    text = re.sub(r'^[\*\-]\s+', '• ', text, flags=re.MULTILINE)
-    
-    # Escape special HTML chars that aren't part of our tags
-    # (Telegram needs <, >, & to be escaped if not in tags)
-    # We do this AFTER our conversions
-    def escape_outside_tags(text):
-        # Split by tags and escape the non-tag parts
-        parts = re.split(r'(<[^>]+>)', text)
-        escaped = []
-        for part in parts:
-            if part.startswith('<') and part.endswith('>'):
-                escaped.append(part)  # Keep tags as-is
-            else:
-                # Escape special chars in text
-                part = part.replace('&', '&amp;')
-                part = part.replace('<', '&lt;')
-                part = part.replace('>', '&gt;')
-                escaped.append(part)
-        return ''.join(escaped)
-    
-    text = escape_outside_tags(text)
+    return _render(text)
+
+
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit per message
+
+def _chunks(text, max_length=MAX_MESSAGE_LENGTH):
+    """
+    Yield pieces of text no longer than max_length, splitting at the last
+    newline that fits (hard cut if a single line is too long).
+    Single pass with slicing - no per-line string building.
+    """
+    i = 0
+    length = len(text)
+    while i < length:
+        if length - i > max_length:
+            j = text.rfind('\n', i, i + max_length)
+            if j <= i:
+                j = i + max_length
+        else:
+            j = length
+        yield text[i:j]
+        # Skip the newline we split on
+        i = j + 1 if j < length and text[j] == '\n' else j
+
+
+async def _send_chunk(update, chunk, parse_mode):
+    """Send one chunk, falling back to plainer text if Telegram rejects it"""
+    # Try 1: With formatting
+    if parse_mode:
+        try:
+            await safe_reply(update, chunk, parse_mode=parse_mode)
+            return
+        except Exception as e:
+            logger.warning(f"{parse_mode} parse failed: {e}")
     
-    return text
+    # Try 2: Plain text (strip all HTML/markdown)
+    try:
+        clean = _RE_TAG.sub('', chunk)  # Remove HTML tags
+        clean = _RE_MDCHARS.sub('', clean)    # Remove markdown chars
+        await safe_reply(update, clean)
+    except Exception as e2:
+        logger.error(f"Even plain text failed: {e2}")
+        # Last resort - super clean
+        try:
+            ultra_clean = ''.join(c for c in chunk if c.isprintable() or c in '\n\r\t')
+            await safe_reply(update, ultra_clean[:MAX_MESSAGE_LENGTH])
+        except:
+            pass
 
 
 async def send_long_message(update, text, use_html=True):
@@ -99,8 +397,6 @@ async def send_long_message(update, text, use_html=True):
     Split and send long messages with PROPER error handling
     Uses HTML by default (more reliable!)
     """
-    MAX_LENGTH = 4096
-    
     # Convert to HTML format
     if use_html:
         try:
@@ -112,75 +408,110 @@ async def send_long_message(update, text, use_html=True):
     else:
         parse_mode = None
     
-    # Split if needed
-    if len(text) <= MAX_LENGTH:
-        chunks = [text]
-    else:
-        # Smart splitting - try to split at newlines
-        chunks = []
-        current_chunk = ""
-        for line in text.split('\n'):
-            if len(current_chunk) + len(line) + 1 <= MAX_LENGTH:
-                current_chunk += line + '\n'
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                current_chunk = line + '\n'
-        if current_chunk:
-            chunks.append(current_chunk)
+    # Split if needed (smart splitting - at newlines when possible)
+    chunks = list(_chunks(text, MAX_MESSAGE_LENGTH))
     
-    # Send each chunk with fallback
+    # One after another on purpose: Telegram doesn't guarantee the order of
+    # concurrent sends, and the per-chat limiter paces them to 1/sec anyway
     for chunk in chunks:
-        sent = False
-        
-        # Try 1: With formatting
-        if parse_mode:
-            try:
-                await update.message.reply_text(chunk, parse_mode=parse_mode)
-                sent = True
-            except Exception as e:
-                logger.warning(f"{parse_mode} parse failed: {e}")
-        
-        # Try 2: Plain text (strip all HTML/markdown)
-        if not sent:
-            try:
-                clean = re.sub(r'<[^>]+>', '', chunk)  # Remove HTML tags
-                clean = re.sub(r'[*_`]', '', clean)    # Remove markdown chars
-                await update.message.reply_text(clean)
-                sent = True
-            except Exception as e2:
-                logger.error(f"Even plain text failed: {e2}")
-                # Last resort - super clean
-                try:
-                    ultra_clean = ''.join(c for c in chunk if c.isprintable() or c in '\n\r\t')
-                    await update.message.reply_text(ultra_clean[:MAX_LENGTH])
-                except:
-                    pass
+        await _send_chunk(update, chunk, parse_mode)
 # ============================================
 
+# ===== MODEL CACHE =====
+@functools.lru_cache(maxsize=256)
+def _get_model(model_name, temperature, system_prompt):
+    """Build a GenerativeModel once per (model, temperature, prompt) combo"""
+    return genai.GenerativeModel(
+        model_name=model_name,
+        generation_config={
+            "temperature": temperature,
+        },
+        system_instruction=system_prompt
+    )
+
+@functools.lru_cache(maxsize=1)
+def _get_image_model():
+    return genai.GenerativeModel(
+        model_name='gemini-2.5-flash',
+        generation_config={
+            "response_modalities": ["TEXT", "IMAGE"]
+        }
+    )
+# =======================
+
 class UserSession:
-    def __init__(self):
-        self.history = []
+    max_history = 1000
+    
+    def __init__(self, user_id):
+        self.user_id = user_id
+        # Ring buffer of (role, text): oldest messages fall off automatically, O(1) appends
+        self.history = deque(maxlen=self.max_history)
         self.system_prompt = "You are a helpful AI assistant."
         self.temperature = 0.7
         self.model_name = "gemini-2.5-flash"
-        self.max_history = 1000
+        self._model = None
+    
+    def get_model(self):
+        # Lazily grab the shared model for the current settings
+        if self._model is None:
+            self._model = _get_model(self.model_name, self.temperature, self.system_prompt)
+        return self._model
+    
+    def settings_changed(self):
+        # Call this whenever model_name / temperature / system_prompt change
+        self._model = None
+        db_enqueue("settings", self.user_id, self.system_prompt, self.temperature, self.model_name)
     
     def add_message(self, role, content):
-        self.history.append({"role": role, "parts": [content]})
-        if len(self.history) > self.max_history:
-            self.history = self.history[-self.max_history:]
+        self.history.append((role, content))
+        db_enqueue("message", self.user_id, time.time(), role, content)
     
     def clear_history(self):
-        self.history = []
-
-def get_session(user_id):
-    if user_id not in user_sessions:
-        user_sessions[user_id] = UserSession()
-    return user_sessions[user_id]
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    welcome_msg = """
+        self.history.clear()
+        db_enqueue("clear", self.user_id)
+    
+    def to_sdk(self):
+        # Gemini wants [{"role": ..., "parts": [...]}] - only build it per request
+        return [{"role": role, "parts": [content]} for role, content in self.history]
+
+async def get_session(user_id):
+    session = user_sessions.get(user_id)
+    if session is not None:
+        user_sessions.move_to_end(user_id)
+        return session
+    
+    session = await load_session(user_id)
+    # Another handler may have loaded this user while we were waiting on the DB
+    if user_id in user_sessions:
+        user_sessions.move_to_end(user_id)
+        return user_sessions[user_id]
+    user_sessions[user_id] = session
+    if len(user_sessions) > MAX_SESSIONS:
+        user_sessions.popitem(last=False)
+    return session
+
+# ===== PRESETS =====
+# Built once at import instead of on every /persona or /model call
+PERSONAS = MappingProxyType({
+    "helpful": "You are a helpful, friendly AI assistant.",
+    "coding": "You are an expert programmer who writes clean, efficient code and explains technical concepts clearly.",
+    "creative": "You are a creative writer who tells engaging stories and creates compelling content.",
+    "roast": "You are a sarcastic AI who roasts people in a funny way (but keeps it friendly).",
+    "teacher": "You are a patient teacher who explains things step-by-step in simple terms."
+})
+_PERSONAS_LIST_HTML = "\n".join(f"• <code>{k}</code> - {v}" for k, v in PERSONAS.items())
+_PERSONAS_TEXT = f"🎭 Available Personas:\n\n{_PERSONAS_LIST_HTML}\n\nUse /persona &lt;name&gt; to select."
+
+MODELS = MappingProxyType({
+    "pro": "gemini-2.5-pro",
+    "flash": "gemini-2.5-flash"
+})
+_MODELS_TEXT = "\n\nAvailable:\n• /model pro - Gemini Pro\n• /model flash - Gemini Flash (faster)"
+# ===================
+
+# ===== STATIC MENUS =====
+# Already Telegram-safe HTML, so they are sent as-is
+_WELCOME_HTML = """
 🤖 <b>Welcome to AI Chat Bot!</b>
 
 I'm powered by Google Gemini AI. Let's chat!
@@ -197,10 +528,8 @@ I'm powered by Google Gemini AI. Let's chat!
 
 Just send me a message to start chatting! 🚀
     """
-    await update.message.reply_text(welcome_msg, parse_mode='HTML')
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = """
+_HELP_HTML = """
 📖 <b>Command Guide:</b>
 
 🔄 /reset - Clear your chat history and context
@@ -230,23 +559,31 @@ Example: /image a cute cat wearing sunglasses
 
 Just type normally to chat with me! 💬
     """
-    await update.message.reply_text(help_text, parse_mode='HTML')
+# ==========================
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await safe_reply(update, _WELCOME_HTML, parse_mode='HTML')
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await safe_reply(update, _HELP_HTML, parse_mode='HTML')
 
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await flush_pending(update)
     user_id = update.effective_user.id
-    session = get_session(user_id)
+    session = await get_session(user_id)
     session.clear_history()
-    await update.message.reply_text("🔄 Chat history cleared! Starting fresh. ✨")
+    await safe_reply(update, "🔄 Chat history cleared! Starting fresh. ✨")
 
 async def system_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await flush_pending(update)
     user_id = update.effective_user.id
-    session = get_session(user_id)
+    session = await get_session(user_id)
     
     if not context.args:
         current = session.system_prompt
         # Escape for HTML
-        escaped_prompt = current.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        await update.message.reply_text(
+        escaped_prompt = current.translate(_ESCAPE_TABLE)
+        await safe_reply(update,
             f"📝 Current system prompt:\n\n<code>{escaped_prompt}</code>\n\nUse /system &lt;your prompt&gt; to change it.", 
             parse_mode='HTML'
         )
@@ -254,19 +591,21 @@ async def system_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     new_prompt = ' '.join(context.args)
     session.system_prompt = new_prompt
+    session.settings_changed()
     session.clear_history()
-    escaped_new = new_prompt.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-    await update.message.reply_text(
+    escaped_new = new_prompt.translate(_ESCAPE_TABLE)
+    await safe_reply(update,
         f"✅ System prompt updated!\n\n<code>{escaped_new}</code>\n\nHistory cleared.", 
         parse_mode='HTML'
     )
 
 async def temperature_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await flush_pending(update)
     user_id = update.effective_user.id
-    session = get_session(user_id)
+    session = await get_session(user_id)
     
     if not context.args:
-        await update.message.reply_text(
+        await safe_reply(update,
             f"🌡️ Current temperature: <code>{session.temperature}</code>\n\nUse /temperature &lt;0.0-2.0&gt; to change it.", 
             parse_mode='HTML'
         )
@@ -276,112 +615,107 @@ async def temperature_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         temp = float(context.args[0])
         if 0.0 <= temp <= 2.0:
             session.temperature = temp
-            await update.message.reply_text(f"✅ Temperature set to <code>{temp}</code>", parse_mode='HTML')
+            session.settings_changed()
+            await safe_reply(update, f"✅ Temperature set to <code>{temp}</code>", parse_mode='HTML')
         else:
-            await update.message.reply_text("❌ Temperature must be between 0.0 and 2.0")
+            await safe_reply(update, "❌ Temperature must be between 0.0 and 2.0")
     except ValueError:
-        await update.message.reply_text("❌ Invalid number. Use /temperature 0.7 for example.")
+        await safe_reply(update, "❌ Invalid number. Use /temperature 0.7 for example.")
 
 async def tokens_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await flush_pending(update)
     user_id = update.effective_user.id
-    session = get_session(user_id)
+    session = await get_session(user_id)
     
     msg_count = len(session.history)
     max_count = session.max_history
     
-    await update.message.reply_text(
+    await safe_reply(update,
         f"📊 Context Usage:\n\n💬 Messages in context: {msg_count}/{max_count}\n🧠 Model: {session.model_name}\n🌡️ Temperature: {session.temperature}"
     )
 
 async def persona_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await flush_pending(update)
     user_id = update.effective_user.id
-    session = get_session(user_id)
-    
-    personas = {
-        "helpful": "You are a helpful, friendly AI assistant.",
-        "coding": "You are an expert programmer who writes clean, efficient code and explains technical concepts clearly.",
-        "creative": "You are a creative writer who tells engaging stories and creates compelling content.",
-        "roast": "You are a sarcastic AI who roasts people in a funny way (but keeps it friendly).",
-        "teacher": "You are a patient teacher who explains things step-by-step in simple terms."
-    }
+    session = await get_session(user_id)
     
     if not context.args:
-        persona_list = "\n".join([f"• <code>{k}</code> - {v}" for k, v in personas.items()])
-        await update.message.reply_text(
-            f"🎭 Available Personas:\n\n{persona_list}\n\nUse /persona &lt;name&gt; to select.", 
-            parse_mode='HTML'
-        )
+        await safe_reply(update, _PERSONAS_TEXT, parse_mode='HTML')
         return
     
     persona_name = context.args[0].lower()
-    if persona_name in personas:
-        session.system_prompt = personas[persona_name]
+    if persona_name in PERSONAS:
+        session.system_prompt = PERSONAS[persona_name]
+        session.settings_changed()
         session.clear_history()
-        await update.message.reply_text(
+        await safe_reply(update,
             f"✅ Persona set to <b>{persona_name}</b>!\n\nHistory cleared.", 
             parse_mode='HTML'
         )
     else:
-        await update.message.reply_text("❌ Unknown persona. Use /persona to see available options.")
+        await safe_reply(update, "❌ Unknown persona. Use /persona to see available options.")
 
 async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await flush_pending(update)
     user_id = update.effective_user.id
-    session = get_session(user_id)
-    
-    models = {
-        "pro": "gemini-2.5-pro",
-        "flash": "gemini-2.5-flash"
-    }
+    session = await get_session(user_id)
     
     if not context.args:
-        await update.message.reply_text(
-            f"🤖 Current model: <code>{session.model_name}</code>\n\nAvailable:\n• /model pro - Gemini Pro\n• /model flash - Gemini Flash (faster)", 
+        await safe_reply(update,
+            f"🤖 Current model: <code>{session.model_name}</code>{_MODELS_TEXT}", 
             parse_mode='HTML'
         )
         return
     
     model_key = context.args[0].lower()
-    if model_key in models:
-        session.model_name = models[model_key]
-        await update.message.reply_text(f"✅ Model switched to <code>{session.model_name}</code>", parse_mode='HTML')
+    if model_key in MODELS:
+        session.model_name = MODELS[model_key]
+        session.settings_changed()
+        await safe_reply(update, f"✅ Model switched to <code>{session.model_name}</code>", parse_mode='HTML')
     else:
-        await update.message.reply_text("❌ Unknown model. Use /model to see options.")
+        await safe_reply(update, "❌ Unknown model. Use /model to see options.")
 
 async def image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text(
+        await safe_reply(update,
             "🎨 Usage: /image &lt;your prompt&gt;\n\nExample: /image a futuristic city at sunset", 
             parse_mode='HTML'
         )
         return
     
+    await flush_pending(update)
+    user_id = update.effective_user.id
+    limiter = limiter_for(user_id)
+    if not limiter.has_capacity():
+        await safe_reply(update, RATE_LIMIT_MSG)
+        return
+    await limiter.acquire()
+    
     prompt = ' '.join(context.args)
-    status_msg = await update.message.reply_text("🎨 Generating your image... This might take a moment! ⏳")
+    logger.info(f"Gemini image request from user {user_id}")
+    status_msg = await safe_reply(update, "🎨 Generating your image... This might take a moment! ⏳")
     
     try:
-        image_model = genai.GenerativeModel(
-            model_name='gemini-2.5-flash',
-            generation_config={
-                "response_modalities": ["TEXT", "IMAGE"]
-            }
-        )
+        image_model = _get_image_model()
         
-        response = image_model.generate_content(f"Generate an image: {prompt}")
+        response = await gemini_call(
+            lambda: image_model.generate_content_async(f"Generate an image: {prompt}")
+        )
         
         image_found = False
         for part in response.candidates[0].content.parts:
             if hasattr(part, 'inline_data') and part.inline_data:
                 image_data = part.inline_data.data
                 
-                await update.message.reply_photo(
+                await safe_send(update, lambda: update.message.reply_photo(
                     photo=BytesIO(image_data),
                     caption=f"🎨 Generated: {prompt}"
-                )
+                ))
                 image_found = True
                 break
         
         if not image_found:
-            await update.message.reply_text(
+            await safe_reply(update,
                 "⚠️ No image was generated. The model might not support image generation with your API key."
             )
         
@@ -389,50 +723,189 @@ async def image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         logger.error(f"Image generation error: {e}")
-        await status_msg.edit_text(
+        await safe_send(update, lambda: status_msg.edit_text(
             f"❌ Image generation failed!\n\nError: <code>{str(e)}</code>", 
             parse_mode='HTML'
-        )
+        ))
+
+# ===== MESSAGE DEBOUNCE =====
+# People often send a burst (context, question, log dump...).
+# Wait a moment and send them to Gemini as ONE turn instead of N.
+DEBOUNCE_SECONDS = 0.25
+pending_messages = {}   # key -> list of queued updates
+pending_timers = {}     # key -> asyncio.TimerHandle
+turn_locks = {}         # key -> [asyncio.Lock, number of users] - held for the whole turn
+
+def _pending_key(update):
+    return (update.effective_chat.id, update.message.message_thread_id, update.effective_user.id)
+
+async def _flush(key):
+    """
+    Send everything queued for this key as a single chat turn.
+    Holds the key's lock until the turn is done, so callers wait for any
+    turn that's already in flight.
+    """
+    entry = turn_locks.get(key)
+    if entry is None:
+        entry = turn_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            timer = pending_timers.pop(key, None)
+            if timer:
+                timer.cancel()
+            updates = pending_messages.pop(key, None)
+            if not updates:
+                return
+            user_message = "\n".join(u.message.text for u in updates)
+            # Reply to the last message of the burst
+            await chat_turn(updates[-1], user_message)
+    finally:
+        # Last one out drops the lock so the dict doesn't grow with every user
+        entry[1] -= 1
+        if entry[1] == 0:
+            del turn_locks[key]
+
+async def flush_pending(update):
+    """
+    Commands call this first: it sends anything still queued and waits for
+    a turn that's already talking to Gemini, so e.g. /reset can't clear
+    history while that turn is about to append to it.
+    """
+    await _flush(_pending_key(update))
+# ============================
 
 async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    key = _pending_key(update)
+    pending_messages.setdefault(key, []).append(update)
+    
+    # Restart the timer every time a new message lands
+    timer = pending_timers.pop(key, None)
+    if timer:
+        timer.cancel()
+    loop = asyncio.get_running_loop()
+    pending_timers[key] = loop.call_later(
+        DEBOUNCE_SECONDS, lambda: context.application.create_task(_flush(key))
+    )
+
+# ===== STREAMING =====
+# Edit a live preview while Gemini is still writing, so long answers
+# don't mean 10+ seconds of silence. The per-chat limiter allows about
+# one send/edit per second, so editing more often than that is pointless.
+STREAM_EDIT_INTERVAL = 1.0  # seconds
+
+async def stream_reply(update, response):
+    """
+    Consume a streamed Gemini response, showing progress as it arrives.
+    Answers that finish within STREAM_EDIT_INTERVAL are sent once, formatted,
+    like before. Returns the full response text.
+    """
+    parts = []
+    preview_msg = None
+    preview_text = ""
+    last_edit = time.monotonic()
+    
+    async for chunk in response:
+        try:
+            parts.append(chunk.text)
+        except ValueError:
+            continue  # Chunk without text (e.g. just finish info)
+        
+        now = time.monotonic()
+        if now - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+        last_edit = now
+        
+        preview = ''.join(parts)
+        if len(preview) > MAX_MESSAGE_LENGTH:
+            preview = preview[:MAX_MESSAGE_LENGTH - 1] + "…"
+        if preview == preview_text or not preview.strip():
+            continue
+        try:
+            if preview_msg is None:
+                preview_msg = await safe_reply(update, preview)
+            else:
+                await safe_send(update, lambda: preview_msg.edit_text(preview))
+            preview_text = preview
+        except Exception as e:
+            logger.warning(f"Stream preview failed: {e}")
+    
+    # Raises with the SDK's explanation if nothing usable came back (e.g. blocked)
+    text = response.text
+    
+    if preview_msg is not None:
+        html = convert_to_html(text)
+        if html == preview_text:
+            return text  # Nothing to format, preview is already the answer
+        if len(html) <= MAX_MESSAGE_LENGTH:
+            try:
+                await safe_send(update, lambda: preview_msg.edit_text(html, parse_mode='HTML'))
+                return text
+            except Exception as e:
+                logger.warning(f"Final HTML edit failed: {e}")
+        # Too long for one message (or bad HTML): swap the preview for normal chunks
+        try:
+            await preview_msg.delete()
+        except Exception as e:
+            logger.warning(f"Couldn't delete stream preview: {e}")
+    
+    await send_long_message(update, text, use_html=True)
+    return text
+# =====================
+
+async def chat_turn(update, user_message):
     user_id = update.effective_user.id
-    user_message = update.message.text
-    session = get_session(user_id)
+    session = await get_session(user_id)
     
-    session.add_message("user", user_message)
+    limiter = limiter_for(user_id)
+    if not limiter.has_capacity():
+        await safe_reply(update, RATE_LIMIT_MSG)
+        return
+    await limiter.acquire()
+    logger.info(f"Gemini chat request from user {user_id} ({session.model_name})")
     
     try:
-        model = genai.GenerativeModel(
-            model_name=session.model_name,
-            generation_config={
-                "temperature": session.temperature,
-            },
-            system_instruction=session.system_prompt
-        )
-        
-        chat = model.start_chat(history=session.history[:-1])
-        response = chat.send_message(user_message)
-        ai_response = response.text
+        model = session.get_model()
         
-        session.add_message("model", ai_response)
+        # The new user turn only goes into history once we have an answer,
+        # so a failed request doesn't leave a dangling message behind.
+        # Async call so other users aren't stuck waiting behind this one
+        contents = session.to_sdk()
+        contents.append({"role": "user", "parts": [user_message]})
+        # (only the request itself is retried - once text is streaming we can't redo it)
+        response = await gemini_call(lambda: model.generate_content_async(contents, stream=True))
         
         # FIXED: Using HTML mode by default (more reliable!)
-        await send_long_message(update, ai_response, use_html=True)
+        ai_response = await stream_reply(update, response)
+        
+        session.add_message("user", user_message)
+        session.add_message("model", ai_response)
         
     except Exception as e:
         logger.error(f"Error: {e}")
-        await update.message.reply_text(
+        await safe_reply(update,
             f"❌ Oops! Something went wrong:\n<code>{str(e)}</code>", 
             parse_mode='HTML'
         )
 
 def main():
-    flask_thread = Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
-    logger.info("🌐 Flask server started!")
-    
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # uvloop = faster event loop for all this network I/O (not available on Windows)
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("⚡ Using uvloop")
+    except ImportError:
+        pass
+    
+    # concurrent_updates lets handlers for different users overlap on Gemini I/O
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))